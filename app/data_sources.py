@@ -1,13 +1,52 @@
 # app/data_sources.py
 import os
 import time
+import logging
+import functools
+import threading
 import datetime as dt
-from typing import Dict, List, Tuple
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import orjson
+import numpy as np
 import pandas as pd
 
 API_BASE = "https://v3.football.api-sports.io"
 
+log = logging.getLogger(__name__)
+
+# One keep-alive pool shared by every API-Football call (incl. the threaded probe)
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(
+    pool_connections=16,
+    pool_maxsize=16,
+    # retry transient gateway errors on the same pooled connection; once retries
+    # run out, hand the last response back to the callers' status checks
+    max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=[502, 503, 504],
+                      allowed_methods=["GET"], raise_on_status=False),
+))
+
+# Optional client-side cap, e.g. APIFOOTBALL_RPM=30; 0/unset means no cap
+_RPM = float(os.getenv("APIFOOTBALL_RPM", "0") or 0)
+_rate_lock = threading.Lock()
+_next_slot = 0.0
+
+def _rate_wait():
+    """Space requests at least 60/RPM seconds apart across all threads."""
+    global _next_slot
+    if _RPM <= 0:
+        return
+    with _rate_lock:
+        now = time.monotonic()
+        wait = _next_slot - now
+        _next_slot = max(now, _next_slot) + 60.0 / _RPM
+    if wait > 0:
+        time.sleep(wait)
+
 def _now_utc():
     return dt.datetime.utcnow().replace(tzinfo=dt.timezone.utc)
 
@@ -31,13 +70,57 @@ def _req_headers() -> Dict[str, str]:
     key = os.getenv("API_FOOTBALL_KEY", "").strip()
     return {"x-apisports-key": key} if key else {}
 
-def _http_get_json(path: str, params: Dict) -> Tuple[int, dict, dict]:
+def _quota_exhausted(hdrs) -> bool:
+    """True when API-Football reports no requests left for the day."""
+    try:
+        return int(hdrs.get("x-ratelimit-requests-remaining")) <= 0
+    except (TypeError, ValueError):
+        return False
+
+# (path, params) -> (etag, body) for conditional GETs. LRU-bounded: fixture ids
+# and date windows roll over daily, so old keys would otherwise pile up forever.
+ETAG_CACHE_SIZE = int(os.getenv("ETAG_CACHE_SIZE", "512"))
+_ETAG_CACHE: "OrderedDict[Tuple, Tuple[str, dict]]" = OrderedDict()
+_etag_lock = threading.Lock()
+
+def _etag_get(ckey):
+    with _etag_lock:
+        hit = _ETAG_CACHE.get(ckey)
+        if hit:
+            _ETAG_CACHE.move_to_end(ckey)
+        return hit
+
+def _etag_put(ckey, etag: str, body: dict):
+    with _etag_lock:
+        _ETAG_CACHE[ckey] = (etag, body)
+        _ETAG_CACHE.move_to_end(ckey)
+        while len(_ETAG_CACHE) > ETAG_CACHE_SIZE:
+            _ETAG_CACHE.popitem(last=False)
+
+def _http_get_json(path: str, params: Dict, conditional: bool = True) -> Tuple[int, dict, dict]:
+    """
+    GET + parse. With conditional=True a repeat request sends If-None-Match and
+    a 304 is answered from the cached body (reported as 200); the probe passes
+    False so it always sees the raw upstream status and body.
+    """
     url = f"{API_BASE}{path}"
-    r = requests.get(url, headers=_req_headers(), params=params, timeout=25)
+    ckey = (path, tuple(sorted((k, str(v)) for k, v in params.items())))
+    headers = _req_headers()
+    cached = _etag_get(ckey) if conditional else None
+    if cached:
+        headers["If-None-Match"] = cached[0]
+    _rate_wait()
+    r = SESSION.get(url, headers=headers, params=params, timeout=25)
+    if r.status_code == 304 and cached:
+        # unchanged upstream: reuse the body we already parsed
+        return 200, cached[1], r.headers
     try:
-        j = r.json()
+        j = orjson.loads(r.content)
     except Exception:
         j = {}
+    etag = r.headers.get("ETag")
+    if conditional and r.status_code == 200 and etag and isinstance(j, dict):
+        _etag_put(ckey, etag, j)
     return r.status_code, j, r.headers
 
 def probe_apifootball(leagues: List[str], hours_ahead: int):
@@ -60,10 +143,7 @@ def probe_apifootball(leagues: List[str], hours_ahead: int):
     league_map = _league_map_from_env()
     season = _season_for_date(now)
 
-    for lname in leagues:
-        lid = league_map.get(lname)
-        if not lid:
-            continue
+    def _probe_one(lname: str, lid: str):
         params = {
             "league": lid,
             "season": season,
@@ -71,9 +151,8 @@ def probe_apifootball(leagues: List[str], hours_ahead: int):
             "to": to_s,
             "timezone": "UTC",
         }
-        status, j, hdrs = _http_get_json("/fixtures", params)
-        out["leagues_tried"].append({lname: {"league_id": lid, "params": params}})
-        out["headers"][lname] = {
+        status, j, hdrs = _http_get_json("/fixtures", params, conditional=False)
+        headers_entry = {
             "status": status,
             "x-ratelimit-requests-limit": hdrs.get("x-ratelimit-requests-limit"),
             "x-ratelimit-requests-remaining": hdrs.get("x-ratelimit-requests-remaining"),
@@ -83,15 +162,27 @@ def probe_apifootball(leagues: List[str], hours_ahead: int):
         resp = j.get("response") if isinstance(j, dict) else None
         if isinstance(resp, list) and resp:
             sample = resp[0]
-        out["report"][lname] = {
+        report_entry = {
             "status": status,
             "errors": errors or [],
             "first_item_sample": sample,
             "results_count": (j.get("results") if isinstance(j, dict) else None),
             "paging": j.get("paging") if isinstance(j, dict) else None,
         }
-        # be nice to their API
-        time.sleep(0.2)
+        return params, headers_entry, report_entry
+
+    jobs = [(lname, league_map[lname]) for lname in leagues if league_map.get(lname)]
+    if not jobs:
+        return out
+
+    # Leagues are independent, so probe them concurrently: wall time ~ slowest league
+    with ThreadPoolExecutor(max_workers=min(8, len(jobs))) as ex:
+        results = list(ex.map(lambda job: _probe_one(*job), jobs))
+
+    for (lname, lid), (params, headers_entry, report_entry) in zip(jobs, results):
+        out["leagues_tried"].append({lname: {"league_id": lid, "params": params}})
+        out["headers"][lname] = headers_entry
+        out["report"][lname] = report_entry
 
     return out
 
@@ -121,11 +212,15 @@ def fetch_fixtures(leagues: List[str], hours_ahead: int) -> pd.DataFrame:
             "timezone": "UTC",
         }
         status, j, hdrs = _http_get_json("/fixtures", params)
+        exhausted = _quota_exhausted(hdrs)
+        if exhausted:
+            log.warning("API-Football quota exhausted after %s; skipping remaining leagues", lname)
         if status != 200 or not isinstance(j, dict):
+            if exhausted:
+                break
             continue
         for it in j.get("response", []) or []:
             fx = it.get("fixture", {})
-            league = it.get("league", {})
             teams = it.get("teams", {})
             mid = fx.get("id")
             date = fx.get("date")  # e.g. "2025-08-22T19:00:00+00:00"
@@ -142,11 +237,46 @@ def fetch_fixtures(leagues: List[str], hours_ahead: int) -> pd.DataFrame:
                 tm_home,
                 tm_away,
             ])
+        if exhausted:
+            break
         time.sleep(0.2)
 
     df = pd.DataFrame(rows, columns=["match_id","league","utc_kickoff","home","away"])
     return df
 
+# Only a few dozen distinct labels show up across a whole slate, so the
+# string normalization below is memoized.
+@functools.lru_cache(maxsize=4096)
+def _norm_1x2_label(sel: str) -> str:
+    low = sel.lower()
+    if low in ("home", "1"):
+        return "Home"
+    if low in ("away", "2"):
+        return "Away"
+    if low in ("draw", "x"):
+        return "Draw"
+    return sel
+
+@functools.lru_cache(maxsize=4096)
+def _ou_label(label: str) -> Optional[Tuple[str, str]]:
+    """
+    "Over 2.5" -> ("OU2.5", "Over"); None when the label isn't a totals line.
+    """
+    sel, line = None, None
+    low = label.lower()
+    if low.startswith("over "):
+        sel = "Over"; line = label[5:].strip()
+    elif low.startswith("under "):
+        sel = "Under"; line = label[6:].strip()
+    if not (sel and line):
+        return None
+    # keep plain "2.5", "3.25" -> market key OU2.5
+    try:
+        L = float(line)
+    except Exception:
+        return None
+    return f"OU{L}".replace(".0", ""), sel
+
 def _parse_1x2(bet_obj) -> List[Tuple[str, float]]:
     """
     bet_obj e.g. {"name": "Match Winner", "values": [{"value":"Home","odd":"1.83"}, ...]}
@@ -157,18 +287,13 @@ def _parse_1x2(bet_obj) -> List[Tuple[str, float]]:
     for v in vals:
         sel = (v.get("value") or "").strip()
         odd = v.get("odd")
+        if odd is None:
+            continue
         try:
             price = float(str(odd))
         except Exception:
             continue
-        # Normalize selection labels
-        if sel.lower() in ("home", "1"):
-            sel = "Home"
-        elif sel.lower() in ("away", "2"):
-            sel = "Away"
-        elif sel.lower() in ("draw", "x"):
-            sel = "Draw"
-        out.append((sel, price))
+        out.append((_norm_1x2_label(sel), price))
     return out
 
 def _parse_over_under(bet_obj) -> List[Tuple[str, str, float]]:
@@ -182,26 +307,34 @@ def _parse_over_under(bet_obj) -> List[Tuple[str, str, float]]:
     for v in vals:
         label = (v.get("value") or "").strip()
         odd = v.get("odd")
+        if odd is None:
+            continue
         try:
             price = float(str(odd))
         except Exception:
             continue
-        sel, line = None, None
-        low = label.lower()
-        if low.startswith("over "):
-            sel = "Over"; line = label[5:].strip()
-        elif low.startswith("under "):
-            sel = "Under"; line = label[6:].strip()
-        if sel and line:
-            # keep plain "2.5", "3.25" -> market key OU2.5
-            try:
-                L = float(line)
-                mkt = f"OU{L}".replace(".0", "")
-                out.append((mkt, sel, price))
-            except Exception:
-                continue
+        parsed = _ou_label(label)
+        if parsed:
+            out.append((parsed[0], parsed[1], price))
     return out
 
+def _with_market_cols(odds: pd.DataFrame) -> pd.DataFrame:
+    """
+    Parse the market key once at the fetch boundary into ou_line (float total
+    line for OU rows, NaN elsewhere), and store the low-cardinality text columns
+    as categoricals. ou_line is a helper for /run, not part of the sheet schema.
+    """
+    for c in ("league", "market", "selection", "book"):
+        odds[c] = odds[c].astype("category")
+    # Parse each distinct market key once, then gather by category code
+    cats = odds["market"].cat.categories.astype(str).to_series()
+    codes = odds["market"].cat.codes.to_numpy()
+    is_ou = cats.str.startswith("OU").to_numpy()
+    lines = pd.to_numeric(cats.str[2:].where(is_ou), errors="coerce").to_numpy(dtype=float)
+    # code -1 (missing market) lands on the appended NaN slot
+    odds["ou_line"] = np.append(lines, np.nan)[codes]
+    return odds
+
 def fetch_odds(fixtures_df: pd.DataFrame,
                leagues: List[str],
                hours_ahead: int,
@@ -212,17 +345,29 @@ def fetch_odds(fixtures_df: pd.DataFrame,
     """
     key = os.getenv("API_FOOTBALL_KEY", "").strip()
     if not key or fixtures_df.empty:
-        return pd.DataFrame(columns=["match_id","league","utc_kickoff","market","selection","price","book","home","away"])
+        return _with_market_cols(pd.DataFrame(columns=["match_id","league","utc_kickoff","market","selection","price","book","home","away"]))
 
-    rows = []
     # Deduplicate fixtures to be safe
-    fixtures = fixtures_df[["match_id","league","utc_kickoff","home","away"]].drop_duplicates()
+    fixtures = fixtures_df[["match_id","league","utc_kickoff","home","away"]].drop_duplicates().reset_index(drop=True)
+
+    book_l = book_filter.lower()
 
-    for _, fx in fixtures.iterrows():
-        mid = fx["match_id"]
+    # Column-wise accumulators; per-fixture columns are gathered by position at the end
+    fx_pos: List[int] = []
+    markets: List[str] = []
+    selections: List[str] = []
+    prices: List[float] = []
+    books: List[str] = []
+
+    for pos, mid in enumerate(fixtures["match_id"]):
         params = {"fixture": mid}
         status, j, hdrs = _http_get_json("/odds", params)
+        exhausted = _quota_exhausted(hdrs)
+        if exhausted:
+            log.warning("API-Football quota exhausted at fixture %s; returning odds collected so far", mid)
         if status != 200 or not isinstance(j, dict):
+            if exhausted:
+                break
             continue
         resp = j.get("response") or []
         for item in resp:
@@ -230,31 +375,46 @@ def fetch_odds(fixtures_df: pd.DataFrame,
             bms = item.get("bookmakers") or []
             for bm in bms:
                 book_name = (bm.get("name") or "").strip()
-                if book_filter and book_filter.lower() not in book_name.lower():
+                if book_l and book_l not in book_name.lower():
                     # if filtering by a book keyword
                     continue
                 bets = bm.get("bets") or []
                 for bet in bets:
                     bname = (bet.get("name") or "").lower()
                     if "match winner" in bname or bname == "1x2":
-                        for sel, price in _parse_1x2(bet):
-                            rows.append([
-                                mid, fx["league"], fx["utc_kickoff"], "1X2", sel, price, book_name, fx["home"], fx["away"]
-                            ])
+                        parsed = [("1X2", sel, price) for sel, price in _parse_1x2(bet)]
                     elif "over/under" in bname:
-                        for mkt, sel, price in _parse_over_under(bet):
-                            rows.append([
-                                mid, fx["league"], fx["utc_kickoff"], mkt, sel, price, book_name, fx["home"], fx["away"]
-                            ])
+                        parsed = _parse_over_under(bet)
+                    else:
+                        continue
+                    for mkt, sel, price in parsed:
+                        fx_pos.append(pos)
+                        markets.append(mkt)
+                        selections.append(sel)
+                        prices.append(price)
+                        books.append(book_name)
+        if exhausted:
+            break
         time.sleep(0.2)
 
-    if not rows:
-        return pd.DataFrame(columns=["match_id","league","utc_kickoff","market","selection","price","book","home","away"])
+    if not prices:
+        return _with_market_cols(pd.DataFrame(columns=["match_id","league","utc_kickoff","market","selection","price","book","home","away"]))
 
-    odds = pd.DataFrame(rows, columns=["match_id","league","utc_kickoff","market","selection","price","book","home","away"])
+    fx = fixtures.iloc[np.asarray(fx_pos, dtype=np.intp)]
+    odds = pd.DataFrame({
+        "match_id": fx["match_id"].to_numpy(),
+        "league": fx["league"].to_numpy(),
+        "utc_kickoff": fx["utc_kickoff"].to_numpy(),
+        "market": markets,
+        "selection": selections,
+        "price": np.fromiter(prices, dtype=np.float64, count=len(prices)),
+        "book": books,
+        "home": fx["home"].to_numpy(),
+        "away": fx["away"].to_numpy(),
+    })
 
     # Keep best price per outcome per match/market
     odds = odds.sort_values("price", ascending=False).drop_duplicates(
         subset=["match_id","market","selection"], keep="first"
     )
-    return odds
+    return _with_market_cols(odds)
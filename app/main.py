@@ -1,19 +1,148 @@
 # app/main.py
 import os
-from flask import Flask, request, jsonify, render_template
+import time
+import hashlib
+import functools
+import threading
+from flask import Flask, request, jsonify, render_template, make_response, url_for
+from flask.json.provider import DefaultJSONProvider
+import orjson
+import numpy as np
 import pandas as pd
 
-from app.sheets import SheetClient
+from app.sheets import SheetClient, is_retryable_error, is_stale_auth_error, reset_auth
 from app.data_sources import fetch_fixtures, fetch_odds, probe_apifootball
-from app.model import predict_match, market_probs
+from app.model import predict_match_batch, market_probs_batch
 from app.markets import find_value_bets
 from app.staking import StakeSizer
 
+class ORJSONProvider(DefaultJSONProvider):
+    """jsonify() via orjson; falls back to Flask's default() for odd types."""
+    def dumps(self, obj, **kwargs):
+        opts = orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY
+        if self.sort_keys:
+            opts |= orjson.OPT_SORT_KEYS
+        return orjson.dumps(obj, default=self.default, option=opts).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
 app = Flask(__name__)
+app.json = ORJSONProvider(app)
+
+# In-process TTL caches: key -> (monotonic ts, value)
+VIEW_CACHE_TTL     = int(os.getenv("VIEW_CACHE_TTL", "60"))
+FIXTURES_CACHE_TTL = int(os.getenv("FIXTURES_CACHE_TTL", "120"))
+ODDS_CACHE_TTL     = int(os.getenv("ODDS_CACHE_TTL", "30"))
+_picks_cache = {}     # /run clears it after writing
+_fixtures_cache = {}
+_odds_cache = {}
+_cache_lock = threading.Lock()  # /view and /run threads share these dicts
+
+def _cached(cache: dict, key, ttl: float, fn, *args, **kwargs):
+    hit = cache.get(key)
+    now = time.monotonic()
+    if hit and now - hit[0] < ttl:
+        return hit[1]
+    val = fn(*args, **kwargs)
+    with _cache_lock:
+        # Purge expired entries on insert: keys like the odds fixture tuple change
+        # with every new slate, and stale frames would otherwise never be freed.
+        # list() snapshots the items, since /run may clear() a cache meanwhile.
+        for k, (ts, _) in list(cache.items()):
+            if now - ts >= ttl:
+                cache.pop(k, None)
+        cache[key] = (now, val)
+    return val
+
+# Optional spreadsheet id; skips the by-name Drive lookup when opening
+SHEET_KEY = os.getenv("SHEET_KEY", "").strip()
+
+@functools.lru_cache(maxsize=4)
+def _sheet_client(sheet_name: str) -> SheetClient:
+    # One authorized client + opened spreadsheet per worker, shared by /run and /view
+    return SheetClient(sheet_name, sheet_key=SHEET_KEY)
+
+def _sheet_call(sheet_name: str, fn):
+    # A cached client can go stale (expired session, dropped connection): on a
+    # 401, 5xx or transport error drop it and retry once with a fresh one.
+    # Anything else (missing env var, bad payload, quota 429) would just fail
+    # the same way twice.
+    try:
+        return fn(_sheet_client(sheet_name))
+    except Exception as e:
+        if not is_retryable_error(e):
+            raise
+        if is_stale_auth_error(e):
+            # the authorized session is memoized separately; re-authorize too
+            reset_auth()
+        _sheet_client.cache_clear()
+        return fn(_sheet_client(sheet_name))
+
+def _load_picks(sheet_name: str):
+    picks = _sheet_call(sheet_name, lambda sc: sc.read_table("picks"))
+    # /view filters market/league/book by category; convert once per read
+    # rather than on every filtered request
+    picks = picks.assign(**{c: picks[c].astype("category")
+                            for c in ("market", "league", "book") if c in picks.columns})
+    # Hashed once per read and cached with the frame: a content digest stays the
+    # same across TTL re-reads of unchanged data and in every worker process
+    return picks, _frames_digest(picks)
+
+def _read_picks_cached(sheet_name: str):
+    """(picks frame, content digest) for the picks tab, behind VIEW_CACHE_TTL."""
+    return _cached(_picks_cache, sheet_name, VIEW_CACHE_TTL, _load_picks, sheet_name)
+
+# /run guards: at most RUN_CONCURRENCY runs in flight, and (if RUN_RPM > 0)
+# a token bucket allowing RUN_RPM runs per minute
+RUN_SEMAPHORE = threading.BoundedSemaphore(int(os.getenv("RUN_CONCURRENCY", "1")))
+RUN_RPM = float(os.getenv("RUN_RPM", "0") or 0)
+# Room for at least one token, or a fractional rate (0.5 = one run per 2 min) never fills
+RUN_BURST = max(1.0, RUN_RPM)
+_run_bucket = {"tokens": RUN_BURST, "ts": time.monotonic()}
+_run_bucket_lock = threading.Lock()
+# A /run arriving within RUN_COALESCE_SECS of the last successful write replays its result
+RUN_COALESCE_SECS = float(os.getenv("RUN_COALESCE_SECS", "30") or 0)
+_last_run = {"ts": 0.0, "result": None}
+# Callers that find every run slot busy wait (up to RUN_WAIT_SECS) for the next
+# run to finish and share its result; "done" counts finished runs
+RUN_WAIT_SECS = float(os.getenv("RUN_WAIT_SECS", "120") or 0)
+_run_done = threading.Condition()
+_run_seq = {"done": 0, "result": None}
+# Digest of the inputs behind the last successful sheet write
+_last_write = {"key": None, "body": None}
+
+def _run_rate_ok() -> bool:
+    if RUN_RPM <= 0:
+        return True
+    with _run_bucket_lock:
+        now = time.monotonic()
+        refill = (now - _run_bucket["ts"]) * RUN_RPM / 60.0
+        _run_bucket["tokens"] = min(RUN_BURST, _run_bucket["tokens"] + refill)
+        _run_bucket["ts"] = now
+        if _run_bucket["tokens"] < 1.0:
+            return False
+        _run_bucket["tokens"] -= 1.0
+        return True
+
+def _frames_digest(*dfs) -> str:
+    h = hashlib.blake2b(digest_size=16)
+    for df in dfs:
+        h.update("|".join(map(str, df.columns)).encode())
+        h.update(pd.util.hash_pandas_object(df, index=False).to_numpy().tobytes())
+    return h.hexdigest()
 
 def _env_leagues():
     return [s.strip() for s in os.getenv("LEAGUES", "EPL,LaLiga").split(",") if s.strip()]
 
+def _category_mask(col: pd.Series, test) -> np.ndarray:
+    """Run a string predicate over a column's categories once, then gather it by code."""
+    if not isinstance(col.dtype, pd.CategoricalDtype):
+        col = col.astype(str).astype("category")  # cached picks are categorical already
+    hits = np.asarray(test(col.cat.categories.astype(str).to_series()), dtype=bool)
+    # code -1 (missing cell) lands on the appended False slot
+    return np.append(hits, False)[col.cat.codes.to_numpy()]
+
 @app.route("/")
 def health():
     return "OK", 200
@@ -39,6 +168,41 @@ def run():
     if want and got != want:
         return jsonify({"ok": False, "error": "invalid_token"}), 403
 
+    refresh = request.args.get("refresh", "").strip() == "1"
+    last = _last_run["result"]
+    if not refresh and last and time.monotonic() - _last_run["ts"] < RUN_COALESCE_SECS:
+        return jsonify(last[0]), last[1]
+
+    with _run_done:
+        seen = _run_seq["done"]
+    # Single-flight: rather than start a duplicate run, wait for the one in
+    # progress and return its result
+    if not RUN_SEMAPHORE.acquire(blocking=False):
+        with _run_done:
+            if not _run_done.wait_for(lambda: _run_seq["done"] != seen, timeout=RUN_WAIT_SECS):
+                return jsonify({"ok": False, "error": "run_in_progress"}), 429
+            body, status = _run_seq["result"]
+        return jsonify(body), status
+
+    body, status = {"ok": False, "error": "run_failed"}, 500
+    try:
+        if not _run_rate_ok():
+            body, status = {"ok": False, "error": "rate_limited"}, 429
+        else:
+            body, status = _run_once(refresh)
+            # Only replay runs that reached the sheet; a retry after a
+            # transient Sheets failure must get a real second attempt
+            if status == 200 and "sheet_error" not in body:
+                _last_run.update(ts=time.monotonic(), result=(body, status))
+        return jsonify(body), status
+    finally:
+        RUN_SEMAPHORE.release()
+        with _run_done:
+            _run_seq["done"] += 1
+            _run_seq["result"] = (body, status)
+            _run_done.notify_all()
+
+def _run_once(refresh: bool = False):
     sheet_name  = os.getenv("SHEET_NAME", "Football Picks")
     leagues     = _env_leagues()
     hours_ahead = int(os.getenv("HOURS_AHEAD", "240"))
@@ -46,77 +210,82 @@ def run():
     max_picks   = int(os.getenv("MAX_PICKS", "50"))
     book_pref   = os.getenv("BOOK_FILTER", "").strip()
 
+    if refresh:
+        _fixtures_cache.clear()
+        _odds_cache.clear()
+
     # 1) Fixtures
-    fixtures = fetch_fixtures(leagues, hours_ahead)
+    fx_key = (tuple(sorted(leagues)), hours_ahead)
+    fixtures = _cached(_fixtures_cache, fx_key, FIXTURES_CACHE_TTL,
+                       fetch_fixtures, leagues, hours_ahead)
 
     # 2) Odds (API-Football now)
-    odds = fetch_odds(fixtures, leagues, hours_ahead, book_filter=book_pref)
+    odds_key = fx_key + (book_pref, tuple(fixtures["match_id"]))
+    odds = _cached(_odds_cache, odds_key, ODDS_CACHE_TTL,
+                   fetch_odds, fixtures, leagues, hours_ahead, book_filter=book_pref)
+
+    # Same fixtures/odds/settings as the last successful write: the model, picks
+    # and sheet contents would come out identical, so skip straight to the result
+    run_key = _frames_digest(fixtures, odds) + repr((edge_thresh, max_picks, book_pref))
+    if not refresh and _last_write["key"] == run_key:
+        return _last_write["body"], 200
 
     # 3) Model probabilities
-    model_rows = []
     # decide OU lines to compute: any seen in odds, otherwise default [2.5, 3.5]
-    ou_lines_seen = set()
-    if not odds.empty:
-        for m in odds["market"].unique():
-            if m.startswith("OU"):
-                try:
-                    ou_lines_seen.add(float(m[2:]))
-                except Exception:
-                    pass
-    if not ou_lines_seen:
-        ou_lines = (2.5, 3.5)
-    else:
-        ou_lines = tuple(sorted(ou_lines_seen))
+    # (ou_line is parsed once by fetch_odds; np.unique returns the lines sorted)
+    ou_seen = odds["ou_line"].to_numpy(dtype=float)
+    ou_seen = np.unique(ou_seen[~np.isnan(ou_seen)])
+    ou_lines = tuple(ou_seen.tolist()) if ou_seen.size else (2.5, 3.5)
 
-    for _, row in fixtures.iterrows():
-        h, a = str(row["home"]), str(row["away"])
-        lh, la = predict_match(h, a, str(row["league"]))
-        probs = market_probs(lh, la, ou_lines=ou_lines)
-        out = {"match_id": row["match_id"], **probs}
-        model_rows.append(out)
-
-    model_probs_df = pd.DataFrame(model_rows) if model_rows else pd.DataFrame()
+    if fixtures.empty:
+        model_probs_df = pd.DataFrame()
+    else:
+        # One vectorized pass over every fixture instead of a per-row loop
+        lh, la = predict_match_batch(
+            fixtures["home"].astype(str).to_numpy(),
+            fixtures["away"].astype(str).to_numpy(),
+            fixtures["league"].astype(str).to_numpy(),
+        )
+        probs = market_probs_batch(lh, la, ou_lines=ou_lines)
+        model_probs_df = fixtures[["match_id","league","utc_kickoff","home","away"]].assign(**probs)
 
     # 4) Picks
     picks_df = find_value_bets(
-        odds_df=odds,
-        model_df=model_probs_df,
+        fixtures,
+        odds,
+        model_probs_df,
         edge_threshold=edge_thresh,
         max_picks=max_picks,
         book_filter=book_pref
     )
 
     # 5) Write to Google Sheets (best effort, no sys.exit)
+    counts = {
+        "fixtures": len(fixtures.index),
+        "odds_rows": len(odds.index),
+        "model_rows": len(model_probs_df.index),
+        "picks": len(picks_df.index),
+    }
     try:
-        sc = SheetClient(sheet_name)
-        sc.write_table("fixtures", fixtures, header=True)
-        sc.write_table("odds", odds, header=True)
-        sc.write_table("model", model_probs_df, header=True)
-        sc.write_table("picks", picks_df, header=True)
-        sc.write_summary({
-            "fixtures": len(fixtures),
-            "odds_rows": len(odds),
-            "model_rows": len(model_probs_df),
-            "picks": len(picks_df),
-        })
+        tables = {
+            "fixtures": fixtures,
+            "odds": odds.drop(columns=["ou_line"]),
+            "model": model_probs_df,
+            "picks": picks_df,
+            "summary": pd.DataFrame([counts]),
+        }
+        # All tabs in one batched Sheets request (clear + update, so safe to retry)
+        _sheet_call(sheet_name, lambda sc: sc.write_tables(tables))
     except Exception as e:
         # Do not crash the worker; just return diagnostic
-        return jsonify({
-            "ok": True,
-            "fixtures": len(fixtures),
-            "odds_rows": len(odds),
-            "model_rows": len(model_probs_df),
-            "picks": len(picks_df),
-            "sheet_error": str(e)
-        }), 200
-
-    return jsonify({
-        "ok": True,
-        "fixtures": len(fixtures),
-        "odds_rows": len(odds),
-        "model_rows": len(model_probs_df),
-        "picks": len(picks_df),
-    }), 200
+        return {"ok": True, **counts, "sheet_error": str(e)}, 200
+    finally:
+        # picks tab may have changed; next /view should re-read it
+        _picks_cache.clear()
+
+    body = {"ok": True, **counts}
+    _last_write.update(key=run_key, body=body)
+    return body, 200
 
 @app.route("/view")
 def view_picks():
@@ -128,10 +297,17 @@ def view_picks():
         "book": request.args.get("book","").strip(),
         "min_edge": request.args.get("min_edge","").strip(),
         "min_prob": request.args.get("min_prob","").strip(),
+        "limit": request.args.get("limit","").strip(),
+        "offset": request.args.get("offset","").strip(),
     }
+    etag = None
     try:
-        sc = SheetClient(sheet_name)
-        picks = sc.read_table("picks")
+        picks, digest = _read_picks_cached(sheet_name)
+        etag = hashlib.md5(f"{sheet_name}|{digest}|{sorted(qs.items())}".encode()).hexdigest()
+        if request.if_none_match.contains(etag):
+            resp = make_response("", 304)
+            resp.set_etag(etag)
+            return resp
     except Exception:
         picks = pd.DataFrame(columns=[
             "utc_kickoff","match","market","selection","price","book",
@@ -139,35 +315,67 @@ def view_picks():
             "league","home","away","match_id"
         ])
 
-    # Apply filters in memory
-    df = picks.copy()
-    if not df.empty:
-        if qs["market"]:
-            df = df[df["market"].astype(str).str.lower() == qs["market"].lower()]
-        if qs["league"]:
-            df = df[df["league"].astype(str).str.lower() == qs["league"].lower()]
-        if qs["book"]:
-            df = df[df["book"].astype(str).str.contains(qs["book"], case=False, na=False)]
+    # Apply filters in memory: AND every predicate into one mask, slice once.
+    # Nothing below mutates picks (it may be the cached frame), so no copy needed.
+    df = picks
+    market_q, league_q, book_q = qs["market"].lower(), qs["league"].lower(), qs["book"].lower()
+    has_filters = any(qs[k] for k in ("market", "league", "book", "min_edge", "min_prob"))
+    if has_filters and not df.empty:
+        mask = np.ones(len(df), dtype=bool)
+        # market/league/book are low-cardinality: compare categories, not every cell
+        if market_q:
+            mask &= _category_mask(df["market"], lambda c: c.str.lower() == market_q)
+        if league_q:
+            mask &= _category_mask(df["league"], lambda c: c.str.lower() == league_q)
+        if book_q:
+            mask &= _category_mask(df["book"], lambda c: [book_q in b.lower() for b in c])
         if qs["min_edge"]:
             try:
                 m = float(qs["min_edge"])
-                df = df[df["edge"] >= m]
+                mask &= (df["edge"] >= m).to_numpy()
             except Exception:
                 pass
         if qs["min_prob"]:
             try:
                 p = float(qs["min_prob"])
-                df = df[df["model_prob"] >= p]
+                mask &= (df["model_prob"] >= p).to_numpy()
             except Exception:
                 pass
+        df = df[mask]
+
+    # Optional paging: only the rows shown get turned into dicts for the template
+    try:
+        offset = max(int(qs["offset"] or 0), 0)
+        limit = max(int(qs["limit"] or 0), 0)
+    except ValueError:
+        offset, limit = 0, 0
+    total_rows = len(df)
+    if offset or limit:
+        df = df.iloc[offset:offset + limit] if limit else df.iloc[offset:]
+    # Prev/next links keep the active filters and page size
+    page_args = {k: v for k, v in qs.items() if v and k != "offset"}
+    prev_url = next_url = None
+    if offset > 0:
+        prev_url = url_for("view_picks", **page_args, offset=max(offset - limit, 0) if limit else 0)
+    if limit and offset + limit < total_rows:
+        next_url = url_for("view_picks", **page_args, offset=offset + limit)
 
     leagues = _env_leagues()
-    return render_template(
+    resp = make_response(render_template(
         "picks.html",
         sheet_name=sheet_name,
         rows=df.to_dict(orient="records"),
-        leagues=leagues
-    )
+        leagues=leagues,
+        limit_value=limit or "",
+        total_rows=total_rows,
+        first_row=min(offset + 1, total_rows),
+        last_row=min(offset + len(df), total_rows),
+        prev_url=prev_url,
+        next_url=next_url,
+    ))
+    if etag:
+        resp.set_etag(etag)
+    return resp
 
 if __name__ == "__main__":
     app.run(host="0.0.0.0", port=int(os.getenv("PORT", "8000")))
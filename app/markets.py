@@ -1,4 +1,4 @@
-import math
+import numpy as np
 import pandas as pd
 
 # Expected schemas:
@@ -8,83 +8,51 @@ import pandas as pd
 
 REQUIRED_FIXTURE_COLS = ["match_id", "league", "utc_kickoff", "home", "away"]
 REQUIRED_ODDS_COLS     = ["match_id", "league", "utc_kickoff", "market", "selection", "price", "book", "home", "away"]
+PICK_COLS = [
+    "utc_kickoff", "match", "market", "selection", "price", "book",
+    "model_prob", "implied", "edge", "stake_pct", "stake_amt",
+    "league", "home", "away", "match_id"
+]
 
 def _ensure_cols(df: pd.DataFrame, req):
     if df is None:
         return pd.DataFrame({c: [] for c in req})
-    for c in req:
-        if c not in df.columns:
-            df[c] = "" if c != "price" else pd.NA
-    # coerce price to float when present
-    if "price" in df.columns:
+    # Add only what is missing, on a new frame: callers may pass cached frames
+    have = set(df.columns)
+    missing = [c for c in req if c not in have]
+    if missing:
+        df = df.assign(**{c: ("" if c != "price" else pd.NA) for c in missing})
+    # coerce price to float when present (and not numeric already)
+    if "price" in df.columns and not pd.api.types.is_numeric_dtype(df["price"]):
         try:
-            df["price"] = pd.to_numeric(df["price"], errors="coerce")
+            df = df.assign(price=pd.to_numeric(df["price"], errors="coerce"))
         except Exception:
             pass
     return df
 
-def _implied_prob(price):
-    try:
-        p = 1.0 / float(price)
-        return p if math.isfinite(p) else None
-    except Exception:
-        return None
-
-def _edge(model_p, price):
-    ip = _implied_prob(price)
-    if model_p is None or ip is None:
-        return None
-    return float(model_p) - float(ip)
-
-def _pick_row_common(frow, orow, market, selection, model_p, edge, price):
-    return {
-        "utc_kickoff": frow.get("utc_kickoff", "") or orow.get("utc_kickoff", ""),
-        "match": f"{frow.get('home','')} vs {frow.get('away','')}",
-        "market": market,
-        "selection": selection,
-        "price": price,
-        "book": orow.get("book", ""),
-        "model_prob": model_p if model_p is not None else "",
-        "implied": _implied_prob(price) if price is not None else "",
-        "edge": edge if edge is not None else "",
-        "stake_pct": "",
-        "stake_amt": "",
-        "league": frow.get("league", "") or orow.get("league", ""),
-        "home": frow.get("home", "") or orow.get("home", ""),
-        "away": frow.get("away", "") or orow.get("away", ""),
-        "match_id": frow.get("match_id", "") or orow.get("match_id", ""),
-    }
-
-def _extract_model_prob(model_row: pd.Series, market: str, selection: str):
-    # 1X2
-    if market == "1X2":
-        if selection == "Home":
-            return float(model_row.get("p_H", 0.0))
-        if selection == "Draw":
-            return float(model_row.get("p_D", 0.0))
-        if selection == "Away":
-            return float(model_row.get("p_A", 0.0))
-        return None
-
-    # Totals "OU{line}" where selection is "Over" or "Under"
+_STATIC_KEYS = {("1X2", "Home"): "p_H", ("1X2", "Draw"): "p_D", ("1X2", "Away"): "p_A"}
+
+def _prob_key(market: str, selection: str) -> str:
+    """
+    Model column an odds (market, selection) is priced against ("" when not modelled):
+      1X2 Home/Draw/Away -> p_H / p_D / p_A
+      OU{line} Over/Under -> p_OU{line}_{selection}
+      AH{handicap} Home/Away -> p_H / p_A (basic proxy, can refine later)
+    """
+    key = _STATIC_KEYS.get((market, selection))
+    if key:
+        return key
     if market.startswith("OU"):
-        try:
-            line = market[2:]
-            key = f"p_OU{line}_{selection}"
-            val = model_row.get(key, None)
-            return float(val) if val is not None else None
-        except Exception:
-            return None
-
-    # Asian Handicap "AH{handicap}" — basic proxy (can refine later)
-    if market.startswith("AH"):
-        if selection == "Home":
-            return float(model_row.get("p_H", 0.0))
-        if selection == "Away":
-            return float(model_row.get("p_A", 0.0))
-        return None
+        return f"p_OU{market[2:]}_{selection}"
+    if market.startswith("AH") and selection in ("Home", "Away"):
+        return _STATIC_KEYS[("1X2", selection)]
+    return ""
 
-    return None
+def _prob_keys(market: pd.Series, selection: pd.Series) -> np.ndarray:
+    """_prob_key per odds row, evaluated once per distinct (market, selection) pair."""
+    codes, pairs = pd.MultiIndex.from_arrays([market, selection]).factorize()
+    table = np.array([_prob_key(m, s) for m, s in pairs], dtype=object)
+    return table[codes]
 
 def find_value_bets(
     fixtures: pd.DataFrame,
@@ -98,72 +66,69 @@ def find_value_bets(
     odds     = _ensure_cols(odds, REQUIRED_ODDS_COLS)
 
     if odds is None or odds.empty or fixtures is None or fixtures.empty:
-        return pd.DataFrame(columns=[
-            "utc_kickoff", "match", "market", "selection", "price", "book",
-            "model_prob", "implied", "edge", "stake_pct", "stake_amt",
-            "league", "home", "away", "match_id"
-        ])
-
-    # Keep only odds that have a matching fixture (ensures league/home/away present)
-    odds = odds.merge(
-        fixtures[["match_id", "league", "utc_kickoff", "home", "away"]],
-        on="match_id", how="inner", suffixes=("", "_fx")
-    )
+        return pd.DataFrame(columns=PICK_COLS)
+
+    # Keep only odds that have a matching fixture (a hash lookup; the merged-in
+    # *_fx columns were never read)
+    odds = odds[odds["match_id"].isin(fixtures["match_id"])]
 
     # Optional book filter
     if book_filter:
         bl = book_filter.lower().strip()
-        odds = odds[odds["book"].astype(str).str.lower().str.contains(bl, na=False)]
+        # plain substring test; avoids the regex engine (and regex metachar surprises)
+        odds = odds[[bl in b.lower() if isinstance(b, str) else False for b in odds["book"].to_numpy()]]
 
-    # Best price per (match_id, market, selection)
-    odds = (
-        odds.sort_values("price", ascending=False)
-            .drop_duplicates(subset=["match_id", "market", "selection"], keep="first")
-            .reset_index(drop=True)
-    )
+    # Best price per (match_id, market, selection): take each group's argmax
+    # instead of sorting every row (unpriced rows can never be picks)
+    odds = odds[odds["price"].notna().to_numpy()].reset_index(drop=True)
+    best = odds.groupby(["match_id", "market", "selection"], observed=True, sort=False)["price"].idxmax()
+    odds = odds.loc[best.to_numpy()].reset_index(drop=True)
 
     if model_probs is None or model_probs.empty:
-        return pd.DataFrame(columns=[
-            "utc_kickoff", "match", "market", "selection", "price", "book",
-            "model_prob", "implied", "edge", "stake_pct", "stake_amt",
-            "league", "home", "away", "match_id"
-        ])
-
-    # Fast lookup for model rows
-    mp_index = {row["match_id"]: row for _, row in model_probs.iterrows() if "match_id" in row and pd.notna(row["match_id"])}
-
-    picks = []
-    for _, orow in odds.iterrows():
-        mid = orow.get("match_id")
-        frow = orow  # already merged
-        mrow = mp_index.get(mid)
-        if mrow is None:
-            continue
-
-        market = str(orow.get("market", ""))
-        sel    = str(orow.get("selection", ""))
-        price  = orow.get("price", None)
-
-        mp = _extract_model_prob(mrow, market, sel)
-        eg = _edge(mp, price)
-        if eg is None or eg < float(edge_threshold):
-            continue
-
-        picks.append(_pick_row_common(frow, orow, market, sel, mp, eg, price))
-
-    if not picks:
-        return pd.DataFrame(columns=[
-            "utc_kickoff", "match", "market", "selection", "price", "book",
-            "model_prob", "implied", "edge", "stake_pct", "stake_amt",
-            "league", "home", "away", "match_id"
-        ])
-
-    out = pd.DataFrame(picks).sort_values("edge", ascending=False).head(int(max_picks)).reset_index(drop=True)
-
-    # Clean any non-finite numbers
-    for col in ("model_prob", "implied", "edge"):
-        if col in out.columns:
-            out[col] = pd.to_numeric(out[col], errors="coerce")
-    out = out.replace([float("inf"), float("-inf")], pd.NA)
-
+        return pd.DataFrame(columns=PICK_COLS)
+
+    # Long form (match_id, key, model_prob), then one join on (match_id, key)
+    # prices every odds row at once (inner: odds without a model row or an
+    # unmodelled market are skipped, as before)
+    prob_cols = [c for c in model_probs.columns if c.startswith("p_")]
+    model_long = (
+        model_probs[["match_id"] + prob_cols]
+            .dropna(subset=["match_id"])
+            .drop_duplicates(subset=["match_id"])
+            .melt(id_vars="match_id", var_name="key", value_name="model_prob")
+    )
+    market = odds["market"].astype(str)
+    selection = odds["selection"].astype(str)
+    odds = odds.assign(market=market, selection=selection, key=_prob_keys(market, selection))
+    odds = odds.merge(model_long, on=["match_id", "key"], how="inner")
+
+    price = odds["price"].to_numpy(dtype=float)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        implied = 1.0 / price
+    model_p = pd.to_numeric(odds["model_prob"], errors="coerce").to_numpy(dtype=float)
+    edge = model_p - implied
+    keep = np.isfinite(implied) & np.isfinite(edge) & (edge >= float(edge_threshold))
+    odds = odds[keep]
+
+    out = pd.DataFrame({
+        "utc_kickoff": odds["utc_kickoff"].to_numpy(dtype=object),
+        "market": odds["market"].to_numpy(dtype=object),
+        "selection": odds["selection"].to_numpy(dtype=object),
+        "price": price[keep],
+        "book": odds["book"].to_numpy(dtype=object),
+        "model_prob": model_p[keep],
+        "implied": implied[keep],
+        "edge": edge[keep],
+        "stake_pct": "",
+        "stake_amt": "",
+        "league": odds["league"].to_numpy(dtype=object),
+        "home": odds["home"].to_numpy(dtype=object),
+        "away": odds["away"].to_numpy(dtype=object),
+        "match_id": odds["match_id"].to_numpy(dtype=object),
+    })
+    if out.empty:
+        return pd.DataFrame(columns=PICK_COLS)
+
+    out = out.sort_values("edge", ascending=False).head(int(max_picks)).reset_index(drop=True)
+    out.insert(1, "match", out["home"].fillna("").astype(str) + " vs " + out["away"].fillna("").astype(str))
     return out
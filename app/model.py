@@ -1,60 +1,85 @@
 import math
+import functools
 import numpy as np
+import pandas as pd
+from scipy.stats import poisson, skellam
 
 # Very simple baseline xG; you can later plug real team strengths
 BASE_HOME_XG = 1.45
 BASE_AWAY_XG = 1.25
 
+@functools.lru_cache(maxsize=4096)
 def predict_match(home: str, away: str, league: str):
     """Return (lambda_home, lambda_away) expected goals (Poisson means)."""
     lam_home = max(0.4, BASE_HOME_XG)
     lam_away = max(0.4, BASE_AWAY_XG)
     return float(lam_home), float(lam_away)
 
+def predict_match_batch(homes, aways, leagues):
+    """
+    predict_match over arrays: (lambda_home, lambda_away) arrays, one entry per fixture.
+    Each distinct (home, away, league) is evaluated once and scattered back.
+    """
+    codes, triples = pd.MultiIndex.from_arrays([homes, aways, leagues]).factorize()
+    lams = np.array([predict_match(h, a, lg) for h, a, lg in triples], dtype=float).reshape(-1, 2)
+    return lams[codes, 0], lams[codes, 1]
+
 def poisson_pmf(lam, k):
     return math.exp(-lam) * (lam ** k) / math.factorial(k)
 
+def poisson_pmf_vec(lam, maxg):
+    """P(X=k) for k = 0..maxg, via the recurrence p[k] = p[k-1] * lam / k."""
+    steps = np.empty(maxg + 1)
+    steps[0] = math.exp(-lam)
+    steps[1:] = lam / np.arange(1, maxg + 1)
+    return np.cumprod(steps)
+
 def score_matrix(lh, la, maxg=7):
-    ph = np.array([poisson_pmf(lh, k) for k in range(maxg + 1)])
-    pa = np.array([poisson_pmf(la, k) for k in range(maxg + 1)])
-    return np.outer(ph, pa)  # P(home=i, away=j)
+    return np.outer(poisson_pmf_vec(lh, maxg), poisson_pmf_vec(la, maxg))  # P(home=i, away=j)
 
-def _prob_ou_over(M, L):
-    over = 0.0
-    maxg = M.shape[0] - 1
-    for i in range(maxg + 1):
-        for j in range(maxg + 1):
-            if (i + j) > L:
-                over += M[i, j]
-    return float(over)
-
-def _prob_diff(M, cmp):
-    """Return P(diff relation holds). cmp is a callable taking (diff)->bool."""
+def _prob_ou_over(lam_total, L):
+    """Total goals ~ Poisson(lh + la); over means total goals > L."""
+    return float(poisson.sf(math.floor(L), lam_total))
+
+@functools.lru_cache(maxsize=None)
+def _diff_index(maxg):
+    """Flat (i - j + maxg) index for every cell of a (maxg+1)^2 score grid."""
+    ks = np.arange(maxg + 1)
+    return (np.subtract.outer(ks, ks) + maxg).ravel()
+
+def _diff_pmf(M):
+    """P(home - away == d) for d = -maxg..maxg, stored at index d + maxg (one pass over M)."""
     maxg = M.shape[0] - 1
-    p = 0.0
-    for i in range(maxg + 1):
-        for j in range(maxg + 1):
-            diff = i - j
-            if cmp(diff):
-                p += M[i, j]
-    return float(p)
-
-def _ah_cover_push_probs(M, home_line: float):
+    return np.bincount(_diff_index(maxg), weights=M.ravel(), minlength=2 * maxg + 1)
+
+def _prob_diff_gt(diff_pmf, L):
+    """P(home - away > L)."""
+    maxg = (len(diff_pmf) - 1) // 2
+    start = min(max(math.floor(L) + 1 + maxg, 0), len(diff_pmf))
+    return float(diff_pmf[start:].sum())
+
+def _prob_diff_eq(diff_pmf, L: int):
+    """P(home - away == L)."""
+    maxg = (len(diff_pmf) - 1) // 2
+    idx = L + maxg
+    return float(diff_pmf[idx]) if 0 <= idx < len(diff_pmf) else 0.0
+
+def _ah_cover_push_probs(diff_pmf, home_line: float):
     """
-    Compute cover & push probabilities for a *home* handicap line.
+    Compute cover & push probabilities for a *home* handicap line from the
+    goal-difference distribution (see _diff_pmf).
     For quarter lines (e.g. -0.25, -0.75), we apply half-stake splits:
       - L = -0.25  =>  0.5 of L=0 and 0.5 of L=-0.5
       - L = -0.75  =>  0.5 of L=-0.5 and 0.5 of L=-1.0
     Returns dict: { "cover": p_cover, "push": p_push }
     """
     # If it's a quarter line, average the two adjacent half/whole lines
-    frac = abs(home_line - round(home_line*2)/2)  # distance to nearest half
     if abs(home_line % 0.5) > 1e-9:  # quarter-line
         # e.g., -0.75 -> average of -0.5 and -1.0
         upper = math.ceil(home_line*2)/2
         lower = math.floor(home_line*2)/2
-        d1 = _ah_cover_push_probs(M, lower)
-        d2 = _ah_cover_push_probs(M, upper)
+        d1 = _ah_cover_push_probs(diff_pmf, lower)
+        d2 = _ah_cover_push_probs(diff_pmf, upper)
         return {
             "cover": 0.5*(d1["cover"]+d2["cover"]),
             "push":  0.5*(d1["push"] +d2["push"]),
@@ -64,17 +89,29 @@ def _ah_cover_push_probs(M, home_line: float):
     if abs(home_line - round(home_line)) < 1e-9:
         # whole number: push possible if diff == L
         L = int(round(home_line))
-        p_push  = _prob_diff(M, lambda d: d ==  L)
-        p_cover = _prob_diff(M, lambda d: d >   L)
+        p_push  = _prob_diff_eq(diff_pmf, L)
+        p_cover = _prob_diff_gt(diff_pmf, L)
     else:
         # half number: no push; cover if diff > L
         L = float(home_line)
         p_push  = 0.0
-        p_cover = _prob_diff(M, lambda d: d >  L)
+        p_cover = _prob_diff_gt(diff_pmf, L)
 
     return {"cover": p_cover, "push": p_push}
 
 def market_probs(lh, la, maxg=7, ou_lines=(2.5,), ah_home_lines=()):
+    """
+    Memoized front for _market_probs: lambdas are quantized to 4 decimals so
+    fixtures with (near-)identical strengths share one evaluation.
+    """
+    probs = _market_probs(
+        round(float(lh), 4), round(float(la), 4), int(maxg),
+        tuple(ou_lines), tuple(ah_home_lines),
+    )
+    return dict(probs)  # callers get their own copy; the cached dict stays pristine
+
+@functools.lru_cache(maxsize=4096)
+def _market_probs(lh, la, maxg, ou_lines, ah_home_lines):
     """
     Compute probabilities for:
       - 1X2
@@ -82,20 +119,25 @@ def market_probs(lh, la, maxg=7, ou_lines=(2.5,), ah_home_lines=()):
       - AH cover for a list of *home-relative* lines (we'll also provide away cover for opposite lines)
     Returns a dict of keys:
       - p_H, p_D, p_A
+      - p_BTTS_Yes / p_BTTS_No
       - p_OU{L}_Over / p_OU{L}_Under
       - p_AH_home_{L}, p_AH_away_{+L} where away line is the opposite of home line
+    1X2, BTTS and OU are closed-form (no maxg truncation); maxg only sizes the AH grid.
     """
-    M = score_matrix(lh, la, maxg=maxg)
+    # 1X2: home - away goals is Skellam(lh, la)
+    home = skellam.sf(0, lh, la)
+    draw = skellam.pmf(0, lh, la)
+    away = skellam.cdf(-1, lh, la)
 
-    # 1X2
-    home = np.tril(M, -1).sum()
-    draw = np.trace(M)
-    away = np.triu(M,  1).sum()
+    # BTTS: goal counts are independent
+    btts_yes = (1.0 - math.exp(-lh)) * (1.0 - math.exp(-la))
 
     out = {
         "p_H": float(home),
         "p_D": float(draw),
         "p_A": float(away),
+        "p_BTTS_Yes": float(btts_yes),
+        "p_BTTS_No": float(1.0 - btts_yes),
     }
 
     # OU lines
@@ -104,20 +146,22 @@ def market_probs(lh, la, maxg=7, ou_lines=(2.5,), ah_home_lines=()):
             Lf = float(L)
         except Exception:
             continue
-        over = _prob_ou_over(M, Lf)
+        over = _prob_ou_over(lh + la, Lf)
         out[f"p_OU{Lf}_Over"]  = float(over)
         out[f"p_OU{Lf}_Under"] = float(1 - over)
 
     # AH lines (home-relative)
+    # One pass over the score grid gives the goal-difference pmf shared by every line
+    diff_pmf = _diff_pmf(score_matrix(lh, la, maxg=maxg)) if ah_home_lines else None
     for L in sorted(set(ah_home_lines)):
         try:
             Lf = float(L)
         except Exception:
             continue
-        d = _ah_cover_push_probs(M, Lf)
+        d = _ah_cover_push_probs(diff_pmf, Lf)
         p_cover_home = d["cover"]      # probability home covers the line
         # For away, the equivalent line is -Lf (because diff = home - away)
-        d2 = _ah_cover_push_probs(M, -Lf)
+        d2 = _ah_cover_push_probs(diff_pmf, -Lf)
         p_cover_away = d2["cover"]
 
         # Store with signed labels
@@ -127,3 +171,48 @@ def market_probs(lh, la, maxg=7, ou_lines=(2.5,), ah_home_lines=()):
         out[f"p_AH_away_{label_away}"] = float(p_cover_away)
 
     return out
+
+def market_probs_batch(lh, la, ou_lines=(2.5,)):
+    """
+    Array version of market_probs for 1X2 / BTTS / OU: lh and la are per-fixture
+    Poisson means; returns the same keys as market_probs, each mapped to an array.
+    """
+    lh = np.round(np.asarray(lh, dtype=float), 4)
+    la = np.round(np.asarray(la, dtype=float), 4)
+    # Fixtures share lambda pairs (the baseline model gives every match the same
+    # ones), so evaluate each distinct pair once and scatter back at the end.
+    pairs, inv = np.unique(np.stack([lh, la], axis=1), axis=0, return_inverse=True)
+    inv = inv.reshape(-1)
+    out = _market_probs_pairs(pairs.tobytes(), tuple(ou_lines))
+    return {k: v[inv] for k, v in out.items()}
+
+@functools.lru_cache(maxsize=64)
+def _market_probs_pairs(pairs_key: bytes, ou_lines):
+    """
+    Vectorized market probabilities over the distinct (lh, la) pairs packed in
+    pairs_key; memoized so consecutive runs over the same slate skip scipy.
+    Callers must not mutate the returned arrays (market_probs_batch gathers copies).
+    """
+    pairs = np.frombuffer(pairs_key, dtype=float).reshape(-1, 2)
+    lh, la = pairs[:, 0], pairs[:, 1]
+
+    btts_yes = np.expm1(-lh) * np.expm1(-la)  # (1 - e^-lh) * (1 - e^-la)
+    out = {
+        "p_H": skellam.sf(0, lh, la),
+        "p_D": skellam.pmf(0, lh, la),
+        "p_A": skellam.cdf(-1, lh, la),
+        "p_BTTS_Yes": btts_yes,
+        "p_BTTS_No": 1.0 - btts_yes,
+    }
+
+    lam_total = lh + la
+    for L in ou_lines:
+        try:
+            Lf = float(L)
+        except Exception:
+            continue
+        over = poisson.sf(math.floor(Lf), lam_total)
+        out[f"p_OU{Lf}_Over"]  = over
+        out[f"p_OU{Lf}_Under"] = 1.0 - over
+
+    return out
@@ -1,14 +1,24 @@
 import os
 import json
 import base64
-import gspread
+import functools
+from typing import Dict
 import pandas as pd
 import numpy as np
-from google.oauth2.service_account import Credentials
-from gspread.exceptions import WorksheetNotFound
+
+# picks columns read back as numbers
+NUMERIC_COLS = ("price", "model_prob", "implied", "edge", "stake_amt")
 
 def _client():
-    sa_b64 = os.environ["GOOGLE_SA_JSON_BASE64"]
+    return _authorized_client(os.environ["GOOGLE_SA_JSON_BASE64"])
+
+@functools.lru_cache(maxsize=2)
+def _authorized_client(sa_b64: str):
+    # One decoded key + authorized session per service account; rotating the
+    # env var yields a new cache key. gspread / google-auth are imported here,
+    # so processes that never touch Sheets don't pay for them at startup.
+    import gspread
+    from google.oauth2.service_account import Credentials
     sa = json.loads(base64.b64decode(sa_b64))
     scopes = [
         "https://www.googleapis.com/auth/spreadsheets",
@@ -17,28 +27,101 @@ def _client():
     creds = Credentials.from_service_account_info(sa, scopes=scopes)
     return gspread.authorize(creds)
 
+def reset_auth():
+    """Drop the memoized authorized sessions so the next client re-authorizes."""
+    _authorized_client.cache_clear()
+
+def _status_code(exc: BaseException):
+    return getattr(getattr(exc, "response", None), "status_code", None)
+
+def is_retryable_error(exc: BaseException) -> bool:
+    """
+    Worth one retry with a fresh client: an expired session (401), a Sheets
+    server error (5xx) or a dropped/timed-out connection. Bad requests, 403/404,
+    quota 429s and credential problems fail the same way again, so they aren't.
+    """
+    import requests
+    if isinstance(exc, (requests.exceptions.ConnectionError, requests.exceptions.Timeout)):
+        return True
+    status = _status_code(exc)
+    return isinstance(status, int) and (status == 401 or 500 <= status < 600)
+
+def is_stale_auth_error(exc: BaseException) -> bool:
+    """True when the authorized session itself is bad (HTTP 401)."""
+    return _status_code(exc) == 401
+
 class SheetClient:
-    def __init__(self, sheet_name: str):
+    def __init__(self, sheet_name: str, sheet_key: str = ""):
         self.gc = _client()
-        self.sh = self.gc.open(sheet_name)
+        # open_by_key is a single Sheets call; open() by name is a Drive search first
+        self.sh = self.gc.open_by_key(sheet_key) if sheet_key else self.gc.open(sheet_name)
 
     def _get_or_create_ws(self, tab: str):
+        from gspread.exceptions import WorksheetNotFound
         try:
             return self.sh.worksheet(tab)
         except WorksheetNotFound:
             return self.sh.add_worksheet(title=tab, rows=200, cols=26)
 
-    def write_table(self, tab: str, df: pd.DataFrame):
-        ws = self._get_or_create_ws(tab)
-        ws.clear()
+    @staticmethod
+    def _table_values(df: pd.DataFrame):
         if df.empty:
-            ws.update("A1", [["empty"]])
-            return
-        clean = df.copy()
-        clean.replace([np.inf, -np.inf], "", inplace=True)
-        clean = clean.where(pd.notnull(clean), "")
-        data = [clean.columns.tolist()] + clean.astype(object).values.tolist()
-        ws.update(data)
+            return [["empty"]]
+        # Column-wise clean: non-finite floats and nulls become "" without a
+        # frame-wide copy or object cast; each column is boxed once by its own
+        # typed tolist(), then the columns are zipped into rows
+        cols = []
+        for _, col in df.items():
+            if col.dtype.kind == "f":
+                arr = col.to_numpy(dtype=float, na_value=np.nan)
+                bad = ~np.isfinite(arr)
+            elif col.dtype.kind in "iub" and isinstance(col.dtype, np.dtype):
+                cols.append(col.to_numpy().tolist())  # plain ints/bools: nothing to blank
+                continue
+            elif isinstance(col.dtype, pd.CategoricalDtype):
+                # Box each distinct value once, then gather by code (-1 = missing -> "")
+                table = np.array(col.cat.categories.tolist() + [""], dtype=object)
+                cols.append(table[col.cat.codes.to_numpy()].tolist())
+                continue
+            elif col.dtype.kind == "M":
+                # Timestamps are not JSON-serializable: format the column in one go
+                arr = col.dt.strftime("%Y-%m-%dT%H:%M:%S%z").to_numpy(dtype=object)
+                bad = pd.isna(arr)
+            else:
+                arr = col.to_numpy(dtype=object)
+                bad = pd.isna(arr) | col.isin([np.inf, -np.inf]).to_numpy()
+            vals = arr.tolist()
+            for i in np.flatnonzero(bad):
+                vals[i] = ""
+            cols.append(vals)
+        return [df.columns.tolist()] + [list(row) for row in zip(*cols)]
+
+    def write_table(self, tab: str, df: pd.DataFrame):
+        self.write_tables({tab: df})
+
+    def write_tables(self, tables: Dict[str, pd.DataFrame]):
+        """
+        Replace several tabs at once: one values.batchClear + one values.batchUpdate
+        instead of a clear/update pair per tab.
+        """
+        existing = {ws.title: ws for ws in self.sh.worksheets()}
+        for tab, df in tables.items():
+            # Size the grid for the frame up front (header row included)
+            rows, cols = max(200, len(df) + 1), max(26, len(df.columns))
+            ws = existing.get(tab)
+            if ws is None:
+                self.sh.add_worksheet(title=tab, rows=rows, cols=cols)
+            elif ws.row_count < rows or ws.col_count < cols:
+                ws.resize(rows=max(rows, ws.row_count), cols=max(cols, ws.col_count))
+        ranges = [f"'{tab}'" for tab in tables]
+        self.sh.values_batch_clear(body={"ranges": ranges})
+        self.sh.values_batch_update(body={
+            "valueInputOption": "RAW",
+            "data": [
+                {"range": f"'{tab}'!A1", "values": self._table_values(df)}
+                for tab, df in tables.items()
+            ],
+        })
 
     def read_table(self, tab: str) -> pd.DataFrame:
         ws = self._get_or_create_ws(tab)
@@ -48,8 +131,14 @@ class SheetClient:
         header, rows = values[0], values[1:]
         if not header:
             return pd.DataFrame()
-        df = pd.DataFrame(rows, columns=header)
-        for c in ["price","model_prob","implied","edge","stake_amt"]:
-            if c in df.columns:
-                df[c] = pd.to_numeric(df[c], errors="coerce")
+        # Build each column once (numeric ones parsed straight from the cell strings)
+        # instead of an all-string frame that is then coerced column by column
+        if not rows:
+            return pd.DataFrame(columns=header)
+        cols = list(zip(*rows))
+        df = pd.DataFrame({
+            i: pd.to_numeric(list(c), errors="coerce") if h in NUMERIC_COLS else list(c)
+            for i, (h, c) in enumerate(zip(header, cols))
+        })
+        df.columns = header
         return df
@@ -1,3 +1,4 @@
+import numpy as np
 import pandas as pd
 
 class StakeSizer:
@@ -6,19 +7,21 @@ class StakeSizer:
         self.min_pct = float(min_pct)
         self.max_pct = float(max_pct)
 
-    def _kelly_half(self, p: float, price: float):
-        b = float(price) - 1.0
-        if b <= 0:
-            return 0.0
-        f_star = (b * p - (1 - p)) / b
-        f_star = max(0.0, f_star) * 0.5  # half-Kelly
+    def _kelly_half(self, p: np.ndarray, price: np.ndarray) -> np.ndarray:
+        """Half-Kelly fraction per pick, clamped to [min_pct, max_pct]; b <= 0 stakes nothing."""
+        p = np.asarray(p, dtype=float)
+        b = np.asarray(price, dtype=float) - 1.0
+        with np.errstate(divide="ignore", invalid="ignore"):
+            f_star = (b * p - (1 - p)) / b
+        f_star = np.fmax(f_star, 0.0) * 0.5  # half-Kelly; NaN -> 0 like max(0.0, nan)
         # clamp
-        return min(max(f_star, self.min_pct), self.max_pct)
+        return np.where(b <= 0, 0.0, np.clip(f_star, self.min_pct, self.max_pct))
 
     def apply(self, picks_df: pd.DataFrame):
         if picks_df.empty:
             return picks_df
-        out = picks_df.copy()
-        out["stake_pct"] = out.apply(lambda r: self._kelly_half(r["model_prob"], r["price"]), axis=1)
-        out["stake_amt"] = (self.bankroll * out["stake_pct"]).round(2)
-        return out
\ No newline at end of file
+        stake_pct = self._kelly_half(
+            picks_df["model_prob"].to_numpy(dtype=float), picks_df["price"].to_numpy(dtype=float)
+        )
+        # assign() returns a new frame without deep-copying the untouched columns
+        return picks_df.assign(stake_pct=stake_pct, stake_amt=np.round(self.bankroll * stake_pct, 2))
\ No newline at end of file